@@ -9,13 +9,14 @@ from .utils import class_auroc
 
 # import the checkpoint API 
 import torch.utils.checkpoint as cp
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 # Support for convolutions over hexagonally packed grids
 import hexagdly
 
 class GridNet(nn.Module):
 	def __init__(self, patch_classifier, patch_shape, grid_shape, n_classes, 
-		use_bn=True, atonce_patch_limit=None):
+		use_bn=True, atonce_patch_limit=None, use_sep=False, mask_bg=False):
 		super(GridNet, self).__init__()
 
 		self.patch_shape = patch_shape
@@ -24,81 +25,122 @@ class GridNet(nn.Module):
 		self.patch_classifier = patch_classifier
 		self.use_bn = use_bn
 		self.atonce_patch_limit = atonce_patch_limit
+		self.use_sep = use_sep
+		self.mask_bg = mask_bg
 
 		self.corrector = self._init_corrector()
-
-		# Define a constant vector to be returned by attempted classification of "background" patches
-		#self.bg = torch.zeros((1,n_classes))
-		# NOTE: This tensor MUST have requires_grad=True for gradient checkpointing to execute. Otherwise, 
-		# it fails during backprop with "element 0 of tensors does not require grad and does not have a grad_fn"
-		self.bg = torch.zeros((1,n_classes), requires_grad=True)
-		self.register_buffer("bg_const", self.bg) # Required for proper device handling with CUDA.
-
-		self.dummy = torch.ones(1, dtype=torch.float32, requires_grad=True)
-		self.register_buffer("dummy_tensor", self.dummy)
+		# Store corrector weights in NHWC layout so cuDNN can dispatch its channels_last kernels.
+		self.corrector = self.corrector.to(memory_format=torch.channels_last)
+
+	# Models saved before switching to non-reentrant checkpointing carry "bg_const" and "dummy_tensor" 
+	# buffers, which are no longer needed. Drop them so those state dicts can still be loaded.
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		for key in ("bg_const", "dummy_tensor"):
+			state_dict.pop(prefix + key, None)
+		super(GridNet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+	# Full kxk convolution over class channels, or if use_sep, a depthwise-separable equivalent:
+	# a depthwise kxk convolution followed by a pointwise 1x1 convolution, costing k^2*C + C^2 rather 
+	# than k^2*C^2 multiply-adds per spot.
+	def _corrector_conv(self, kernel_size, padding):
+		if not self.use_sep:
+			return nn.Conv2d(self.n_classes, self.n_classes, kernel_size, padding=padding)
+		return nn.Sequential(
+			nn.Conv2d(self.n_classes, self.n_classes, kernel_size, padding=padding, groups=self.n_classes),
+			nn.Conv2d(self.n_classes, self.n_classes, 1))
 
 	# Define Sequential model containing convolutional layers in global corrector.
+	# If use_sep, the 5x5 convolutions are made depthwise-separable.
 	def _init_corrector(self):
 		cnn_layers = []
 		cnn_layers.append(nn.Conv2d(self.n_classes, self.n_classes, 3, padding=1))
 		if self.use_bn:
 			cnn_layers.append(nn.BatchNorm2d(self.n_classes))
 		cnn_layers.append(nn.ReLU())
-		cnn_layers.append(nn.Conv2d(self.n_classes, self.n_classes, 5, padding=2))
+		cnn_layers.append(self._corrector_conv(5, padding=2))
 		if self.use_bn:
 			cnn_layers.append(nn.BatchNorm2d(self.n_classes))
 		cnn_layers.append(nn.ReLU())
-		cnn_layers.append(nn.Conv2d(self.n_classes, self.n_classes, 5, padding=2))
+		cnn_layers.append(self._corrector_conv(5, padding=2))
 		if self.use_bn:
 			cnn_layers.append(nn.BatchNorm2d(self.n_classes))
 		cnn_layers.append(nn.ReLU())
 		cnn_layers.append(nn.Conv2d(self.n_classes, self.n_classes, 3, padding=1))
 		return nn.Sequential(*cnn_layers)
 
-	# Wrapper function that calls patch classifier on foreground patches and returns constant values for background.
-	def foreground_classifier(self, x):
-		if torch.max(x) == 0:
-			return self.bg_const
-		else:
-			return self.patch_classifier(x.unsqueeze(0))
-
-	# Helper function to make checkpointing possible in patch_predictions
-	def _ppl(self, patch_list, dummy_arg=None):
-		assert dummy_arg is not None
-		#return torch.cat([self.foreground_classifier(p) for p in patch_list], 0)
-		return self.patch_classifier(patch_list)
+	# Fold BatchNorm layers of the corrector into the preceding convolutions for inference.
+	# Only valid in eval mode, once BN running statistics are fixed -- do not resume training afterwards.
+	def fuse_corrector(self):
+		assert not self.training, "Corrector can only be fused in eval mode"
+		layers = []
+		for m in self.corrector:
+			if isinstance(m, nn.BatchNorm2d) and len(layers) > 0 and type(layers[-1]) == nn.Conv2d:
+				layers[-1] = fuse_conv_bn_eval(layers[-1], m)
+			# Depthwise-separable blocks: fold into the pointwise convolution.
+			elif (isinstance(m, nn.BatchNorm2d) and len(layers) > 0 and type(layers[-1]) == nn.Sequential
+				and type(layers[-1][-1]) == nn.Conv2d):
+				layers[-1][-1] = fuse_conv_bn_eval(layers[-1][-1], m)
+			else:
+				layers.append(m)
+		self.corrector = nn.Sequential(*layers)
+		return self
+
+	# Helper function to make checkpointing possible in patch_predictions.
+	# Classifies all patches at once. If mask_bg, then zeroes predictions for "background" (all-zero) 
+	# patches; otherwise the corrector sees the classifier's logits at background spots, as in models 
+	# trained before masking was introduced. The mask is computed on-device to avoid a host sync per patch.
+	def _ppl(self, patch_list):
+		preds = self.patch_classifier(patch_list)
+		if not self.mask_bg:
+			return preds
+		fgd_mask = patch_list.reshape(patch_list.size(0), -1).abs().amax(dim=1) > 0
+		return preds.masked_fill(~fgd_mask[:,None], 0)
 
 	def patch_predictions(self, x):
 		# Reshape input tensor to be of shape (batch_size * h_grid * w_grid, channels, h_patch, w_patch).
 		patch_list = torch.reshape(x, (-1,)+self.patch_shape)
 
 		if self.atonce_patch_limit is None:
-			patch_pred_list = self._ppl(patch_list, self.dummy_tensor)
+			patch_pred_list = self._ppl(patch_list)
+
+			# Reshaping to (batch, h_grid, w_grid, n_classes) and permuting yields a channels_last view
+			# of shape (batch, n_classes, h_grid, w_grid) without copying.
+			patch_pred_grid = torch.reshape(patch_pred_list, (-1,)+self.grid_shape+(self.n_classes,))
+			patch_pred_grid = patch_pred_grid.permute((0,3,1,2))
 		# Process flattened patch list in fixed-sized chunks, checkpointing the result for each.
+		# NOTE: checkpoint_sequential over layer segments is not used here, as no patch classifier in this tree 
+		# is an nn.Sequential (PatchCNN and DenseNet121 already checkpoint their own feature layers).
 		else:
-			cp_chunks = []
+			# Write each chunk directly into a preallocated channels_last output grid, through a flat 
+			# (batch * h_grid * w_grid, n_classes) view, rather than concatenating a list of chunks.
+			batch_size = len(patch_list) // (self.grid_shape[0] * self.grid_shape[1])
+			patch_pred_grid = torch.empty((batch_size, self.n_classes)+self.grid_shape, 
+				device=patch_list.device, dtype=patch_list.dtype, memory_format=torch.channels_last)
+			patch_pred_list = patch_pred_grid.permute((0,2,3,1)).view(-1, self.n_classes)
+
+			# Checkpointing only pays off when gradients are being computed for the patch classifier.
+			# Scan the parameters once here, rather than once per chunk.
+			cp_enabled = torch.is_grad_enabled() and any(p.requires_grad for p in self.patch_classifier.parameters())
+
 			count = 0
 			while count < len(patch_list):				
 				length = min(self.atonce_patch_limit, len(patch_list)-count)
 				tmp = patch_list.narrow(0, count, length)
 
-				# NOTE: Without at least one input to checkpoint having requires_grad=True, then the gradient tape
-				# will break and gradients for patch classifier will be None/0.
-				if any(p.requires_grad for _,p in self.patch_classifier.named_parameters()):
-					chunk = cp.checkpoint(self._ppl, tmp, self.dummy_tensor)
+				# NOTE: Non-reentrant checkpointing propagates gradients to the patch classifier parameters
+				# even though no input to the checkpointed function requires grad.
+				if cp_enabled:
+					chunk = cp.checkpoint(self._ppl, tmp, use_reentrant=False)
 				else:
-					chunk = self._ppl(tmp, self.dummy_tensor)
+					chunk = self._ppl(tmp)
 
-				cp_chunks.append(chunk)
+				patch_pred_list[count:count+length] = chunk
 				count += self.atonce_patch_limit
-			patch_pred_list = torch.cat(cp_chunks,0)
-
-		patch_pred_grid = torch.reshape(patch_pred_list, (-1,)+self.grid_shape+(self.n_classes,))
-		patch_pred_grid = patch_pred_grid.permute((0,3,1,2))
 
 		return patch_pred_grid
 
 	def forward(self, x):
+		# patch_predictions returns a channels_last grid, matching the layout of the corrector weights.
 		patch_pred_grid = self.patch_predictions(x)
 
 		# Apply global corrector.
@@ -110,9 +152,9 @@ class GridNet(nn.Module):
 # Expects input to employ the addressing scheme employed by HexagDLy.
 class GridNetHex(GridNet):
 	def __init__(self, patch_classifier, patch_shape, grid_shape, n_classes, 
-		use_bn=True, atonce_patch_limit=None):
+		use_bn=True, atonce_patch_limit=None, mask_bg=False):
 		super(GridNetHex, self).__init__(patch_classifier, patch_shape, grid_shape, n_classes, 
-			use_bn, atonce_patch_limit)
+			use_bn, atonce_patch_limit, mask_bg=mask_bg)
 
 	# Note: hexagdly.Conv2d seems to provide same-padding when stride=1.
 	'''def _init_corrector(self):
@@ -129,6 +171,8 @@ class GridNetHex(GridNet):
 
 	# More complex model to make sure there is sufficient complexity to memorize training data:
 	# Conv2d(32)->Conv2d(32)->BN->ReLU->Conv2d(32)->Conv2d(32)->BN->ReLU->Conv2d(n_classes)
+	# NOTE: A HexagDLy kernel of size 1 spans the central spot and its 6 nearest neighbours, so these are
+	# not pointwise (1x1) convolutions and cannot be swapped for nn.Conv2d(..., 1) or folded into one another.
 	def _init_corrector(self):
 		cnn_layers = []
 		cnn_layers.append(hexagdly.Conv2d(in_channels=self.n_classes, out_channels=32, 
@@ -161,7 +205,7 @@ def init_weights(m):
 		nn.init.zeros_(m.bias)
 
 
-import sys, os, time, copy
+import sys, os, time
 import argparse
 
 import matplotlib
@@ -179,13 +223,21 @@ def train_model(model, dataloaders, criterion, optimizer, num_epochs=25, outfile
 
 	val_acc_history = []
 
-	best_model_wts = copy.deepcopy(model.state_dict())
+	# Keep a CPU copy of the best weights, allocated once (in pinned memory if using GPU) and updated in place.
+	best_model_wts = {k: torch.empty_like(v, device='cpu', pin_memory=torch.cuda.is_available()).copy_(v)
+		for k,v in model.state_dict().items()}
 	best_acc = 0.0
 	
 	# GPU support
 	device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 	model.to(device)
 
+	# Grid shapes are fixed for a given dataset, so cuDNN can select the fastest convolution algorithms once.
+	torch.backends.cudnn.benchmark = True
+
+	# Loss scaling for mixed precision training (no-op on CPU).
+	scaler = torch.amp.GradScaler("cuda", enabled=torch.cuda.is_available())
+
 	for epoch in range(num_epochs):
 		print('Epoch {}/{}'.format(epoch, num_epochs - 1), flush=True)
 		print('-' * 10, flush=True)
@@ -203,7 +255,8 @@ def train_model(model, dataloaders, criterion, optimizer, num_epochs=25, outfile
 				for param in model.patch_classifier.parameters():
 					param.requires_grad = True
 			
-			running_loss = 0.0
+			# Accumulate loss on-device to avoid a host sync every batch.
+			running_loss = torch.zeros((), device=device)
 			running_corrects = 0
 			running_foreground = 0
 
@@ -212,66 +265,71 @@ def train_model(model, dataloaders, criterion, optimizer, num_epochs=25, outfile
 
 			# Iterate over data.
 			for batch_ind, (inputs, labels) in enumerate(dataloaders[phase]):
-				inputs = inputs.to(device)
-				labels = labels.to(device)
+				inputs = inputs.to(device, non_blocking=True)
+				labels = labels.to(device, non_blocking=True)
 
 				# forward
 				# track history if only in train
 				with torch.set_grad_enabled(phase == 'train'):
-					# Get model outputs, then filter for foreground patches (label>0).
-					# Use only foreground patches in loss/accuracy calulcations.
-					outputs = model(inputs)
-
-					# Outputs: (batch, classes, d1, d2)
-					# Labels: (batch, d1, d2)
-					assert outputs.shape[2]==labels.shape[1] and outputs.shape[3]==labels.shape[2], "Output tensor does not match label dimensions!"
-
-					outputs = outputs.permute((0,2,3,1))
-					outputs = torch.reshape(outputs, (-1, outputs.shape[-1]))
-					labels = torch.reshape(labels, (-1,))
-					outputs = outputs[labels > 0]
-					labels = labels[labels > 0]
-					labels -= 1	# Foreground classes range between [1, N_CLASS].
-
-					loss = criterion(outputs, labels) / accum_iters
-					_, preds = torch.max(outputs, 1)
-
-					# 05/04/2020 -- for computation of AUROC during training.
-					epoch_labels.append(labels)
-					epoch_softmax.append(nn.functional.softmax(outputs, dim=1))
+					# Run forward pass in mixed precision when on GPU.
+					with torch.autocast("cuda", enabled=torch.cuda.is_available()):
+						# Get model outputs, then filter for foreground patches (label>0).
+						# Use only foreground patches in loss/accuracy calulcations.
+						outputs = model(inputs)
+
+						# Outputs: (batch, classes, d1, d2)
+						# Labels: (batch, d1, d2)
+						assert outputs.shape[2]==labels.shape[1] and outputs.shape[3]==labels.shape[2], "Output tensor does not match label dimensions!"
+
+						outputs = outputs.permute((0,2,3,1))
+						outputs = torch.reshape(outputs, (-1, outputs.shape[-1]))
+						labels = torch.reshape(labels, (-1,))
+						fgd_inds = (labels > 0).nonzero(as_tuple=True)[0]
+						outputs = outputs.index_select(0, fgd_inds)
+						labels = labels.index_select(0, fgd_inds) - 1	# Foreground classes range between [1, N_CLASS].
+
+						loss = criterion(outputs, labels) / accum_iters
+						_, preds = torch.max(outputs, 1)
+
+						# 05/04/2020 -- for computation of AUROC during training.
+						epoch_labels.append(labels)
+						epoch_softmax.append(nn.functional.softmax(outputs.detach(), dim=1))
 
 					# backward + optimize only if in training phase
 					if phase == 'train':
-						loss.backward()
+						scaler.scale(loss).backward()
 						
 						if batch_ind % accum_iters == 0:
-							optimizer.step()
-							optimizer.zero_grad()
+							scaler.step(optimizer)
+							optimizer.zero_grad(set_to_none=True)
 							if f_opt is not None:
-								f_opt.step()
-								f_opt.zero_grad()
+								scaler.step(f_opt)
+								f_opt.zero_grad(set_to_none=True)
+							scaler.update()
 
 				# statistics
-				running_loss += loss.item() * inputs.size(0)
+				running_loss += loss.detach() * inputs.size(0)
 				running_corrects += torch.sum(preds == labels.data)
 				running_foreground += len(labels)
 
 
-			epoch_loss = running_loss / len(dataloaders[phase].dataset)
+			epoch_loss = (running_loss / len(dataloaders[phase].dataset)).item()
 			epoch_acc = running_corrects.double() / running_foreground
 
 			print('{} Loss: {:.4f} Acc: {:.4f}'.format(phase, epoch_loss, epoch_acc), flush=True)
 
 			# 05/04/2020 -- for computation of AUROC during training.
-			epoch_labels = np.concatenate([x.cpu().data.numpy() for x in epoch_labels])
-			epoch_softmax = np.concatenate([x.cpu().data.numpy() for x in epoch_softmax])
+			# Concatenate on-device so each is moved to the host in a single transfer.
+			epoch_labels = torch.cat(epoch_labels).cpu().numpy()
+			epoch_softmax = torch.cat(epoch_softmax).float().cpu().numpy()
 			auroc = class_auroc(epoch_softmax, epoch_labels)
 			print('{} AUROC: {}'.format(phase, "\t".join(list(map(str, auroc)))))
 
-			# deep copy the model
+			# copy the best model weights
 			if phase == 'val' and epoch_acc > best_acc:
 				best_acc = epoch_acc
-				best_model_wts = copy.deepcopy(model.state_dict())
+				for k,v in model.state_dict().items():
+					best_model_wts[k].copy_(v, non_blocking=True)
 				if outfile is not None:
 					torch.save(model.state_dict(), outfile)
 					if f_opt is not None:
@@ -307,6 +365,9 @@ def parse_args():
 	parser.add_argument('-p', '--patch-classifier', type=str, default=None, help='Path to pre-trained patch classifier.')
 	parser.add_argument('-d', '--use-densenet', action="store_true", help='Use DenseNet121 architecture for patch classification.')
 	parser.add_argument('-f', '--finetune', action="store_true", help='Fine-tune parameters of patch classifier.')
+	parser.add_argument('-w', '--workers', type=int, default=2, help='Number of DataLoader worker processes.')
+	parser.add_argument('-m', '--mask-background', action="store_true", help='Zero patch predictions for background patches.')
+	parser.add_argument('-s', '--separable', action="store_true", help='Use depthwise-separable convolutions in corrector.')
 	return parser.parse_args()
 
 if __name__ == "__main__":
@@ -330,8 +391,12 @@ if __name__ == "__main__":
 	n_test = int(0.2 * len(grid_dataset))
 	trainset, testset = random_split(grid_dataset, [len(grid_dataset)-n_test, n_test])
 
-	train_loader = DataLoader(trainset, batch_size=BATCH_SIZE, shuffle=True)
-	test_loader = DataLoader(testset, batch_size=BATCH_SIZE, shuffle=True)
+	# Load batches in background workers into pinned memory, so host-to-device copies can overlap compute.
+	# Each sample is a full grid of patches (~1GB), so keep the number of workers (and prefetched samples) small.
+	loader_kwargs = {"pin_memory": torch.cuda.is_available(), "num_workers": args.workers,
+		"persistent_workers": args.workers > 0}
+	train_loader = DataLoader(trainset, batch_size=BATCH_SIZE, shuffle=True, **loader_kwargs)
+	test_loader = DataLoader(testset, batch_size=BATCH_SIZE, shuffle=True, **loader_kwargs)
 	dataloaders = {"train": train_loader, "val": test_loader}
 
 	g, l = grid_dataset[0]
@@ -343,7 +408,7 @@ if __name__ == "__main__":
 	else:
 		pc = patchcnn_simple(h_patch, w_patch, c, fgd_classes, CP)
 	gnet = GridNet(pc, patch_shape=(c, h_patch, w_patch), grid_shape=(h_st, w_st), n_classes=fgd_classes,
-		use_bn=USE_BN)
+		use_bn=USE_BN, use_sep=args.separable, mask_bg=args.mask_background)
 	#gnet.apply(init_weights)
 
 	# Load parameters of pre-trained patch classifier model, if provided.
@@ -360,6 +425,18 @@ if __name__ == "__main__":
 			for param in gnet.patch_classifier.parameters():
 				param.requires_grad = False
 
+	# Compile the corrector with TorchInductor (PyTorch >= 2.2) so BN/ReLU are fused into the convolutions.
+	# Compiling in place keeps state dict keys unchanged. The patch classifier is left uncompiled, 
+	# as its chunked checkpointing loop would cause graph breaks.
+	# On GPU, "reduce-overhead" additionally captures the corrector's fixed-shape forward/backward as CUDA 
+	# graphs and replays them each step. The rest of the training step can't be captured, as foreground 
+	# filtering (labels > 0) yields data-dependent shapes and GradScaler syncs with the host.
+	# With gradient accumulation, gradients must survive across replays, which CUDA graph trees don't 
+	# guarantee, so the default mode is used instead.
+	if hasattr(nn.Module, "compile"):
+		gnet.corrector.compile(dynamic=False, 
+			mode="reduce-overhead" if torch.cuda.is_available() and ACCUM_ITERS == 1 else "default")
+
 	criterion = nn.CrossEntropyLoss()
 	optimizer = optim.Adam(gnet.parameters(), lr=0.001)
 
@@ -370,6 +447,9 @@ if __name__ == "__main__":
 	# Visualize results from patch predictions, grid predictions on batches of train, test set
 	gnet_fit.eval()
 	gnet_fit.patch_classifier.eval()
+	gnet_fit.fuse_corrector()
+	# NOTE: The patch classifier is not dynamically quantized to int8: quantize_dynamic only reaches Linear 
+	# layers, i.e. the final classification layer of DenseNet121 or the small fully-connected head of PatchCNN.
 	torch.set_grad_enabled(False)
 
 	train_input, train_labels = next(iter(dataloaders["train"]))
@@ -377,8 +457,8 @@ if __name__ == "__main__":
 
 	for batch, labels, name in [(train_input, train_labels, "train"), (test_input, test_labels, "test")]:
 
-		patchpred = np.argmax(gnet_fit.patch_predictions(batch).data.numpy(), axis=1)
-		gridpred = np.argmax(gnet_fit(batch).data.numpy(), axis=1)
+		patchpred = torch.argmax(gnet_fit.patch_predictions(batch), dim=1).cpu().numpy()
+		gridpred = torch.argmax(gnet_fit(batch), dim=1).cpu().numpy()
 		labels = labels.data.numpy()
 
 		# Recall that output of gnet has dimensionality N_class - want to render foreground patches only, and as distinct from background (0)